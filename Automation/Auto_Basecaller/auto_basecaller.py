@@ -3,20 +3,51 @@
 import sys
 import os
 import time
+import atexit
 import logging
+import logging.handlers
+import queue
 import argparse
 import configparser
+import ctypes
+import selectors
+import socket
+import stat
+import struct
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from types import SimpleNamespace
 import signal # For graceful shutdown
+import string
 
 # --- Global Variables ---
 CONFIG = None
-ACTIVE_PROCESSES = {} # Dict mapping run_path_str -> Popen object
+LOG_LISTENER = None # QueueListener that writes log records from a background thread
+ACTIVE_PROCESSES = {} # Dict mapping run Path -> Popen object
+PID_TO_RUNPATH = {} # Dict mapping Popen pid -> run Path
+COMPLETED_BUF = [] # Reused each cycle by the poll() fallback to collect finished runs
 MARKER_PROCESSING = ".processing"
 MARKER_COMPLETED = ".completed"
 MARKER_FAILED = ".failed"
-SHUTDOWN_REQUESTED = False
+SHUTDOWN_EVENT = threading.Event() # Set by the signal handler; safe to check from any thread
+ARGUMENT_PLACEHOLDERS = ("input_dir", "output_dir", "config_path")
+SERVER_PLACEHOLDERS = ("config_path",)
+BASECALL_SERVER = None # Popen of the persistent basecall server, if ServerExecutable is configured
+SERVER_STARTED_AT = None # time.monotonic() of the last server start, used to throttle restarts
+SERVER_READY = False # True once the server accepts connections (or its startup delay has passed)
+SERVER_TERMINATED_AT = None # time.monotonic() of the SIGTERM sent to a server that never became ready
+SERVER_KILL_GRACE = 30 # Seconds a terminated server gets to exit before it is killed
+INOTIFY = None # Inotify watching the watch directory and runs awaiting their signal file, None when falling back to periodic scans
+PENDING_RUNS = set() # Run paths queued for a state check by inotify events
+LAST_FULL_SCAN = None # time.monotonic() of the last full watch directory scan
+WAKEUP_SOCKETS = None # (reader, writer) socket pair that wakes the main loop on signals
+STATE_CACHE = {} # Dict mapping run_path_str -> (state, dir mtime_ns, expiry)
+MARKER_EXECUTOR = None # ThreadPoolExecutor for completion/failure marker updates
+MARKER_UPDATES = {} # Dict mapping run_path_str -> state whose marker is still being written
+STATE_CACHE_TTL = 600 # Seconds; set to STATE_CACHE_TTL_INTERVALS check intervals at startup
+STATE_CACHE_TTL_INTERVALS = 10
 
 # --- Logging Setup ---
 def setup_logging(log_dir_str, log_file, level_str):
@@ -26,14 +57,24 @@ def setup_logging(log_dir_str, log_file, level_str):
     log_dir.mkdir(parents=True, exist_ok=True)
     log_path = log_dir / log_file
 
-    logging.basicConfig(
-        level=log_level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_path),
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
+    # Records are queued by the caller and written by a listener thread, so a slow
+    # terminal or stalled stdout pipe cannot block the main loop.
+    global LOG_LISTENER
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [
+        logging.FileHandler(log_path),
+        logging.StreamHandler(sys.stdout)
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(log_level)
+    root_logger.addHandler(queue_handler) # Not basicConfig, which would format records twice
+    LOG_LISTENER = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    LOG_LISTENER.start()
+    atexit.register(LOG_LISTENER.stop) # Flush queued records on any exit path
     # Use a distinct logger name
     logger = logging.getLogger("BasecallWatcher")
     logger.info("Logging initialized.")
@@ -41,8 +82,28 @@ def setup_logging(log_dir_str, log_file, level_str):
     return logger
 
 # --- Configuration Loading ---
+def compile_arguments(template, placeholders=ARGUMENT_PLACEHOLDERS):
+    """Splits the Arguments template into tokens once, ahead of any launch.
+
+    Each token is a tuple of (literal_text, placeholder) pairs, where placeholder
+    is None for plain text. Raises ValueError for malformed or unknown placeholders.
+    """
+    formatter = string.Formatter()
+    tokens = []
+    for word in template.split():
+        parts = []
+        for literal, field, spec, conversion in formatter.parse(word):
+            if field is not None:
+                if field not in placeholders:
+                    raise ValueError(f"unknown placeholder {{{field}}}")
+                if spec or conversion:
+                    raise ValueError(f"format specs are not supported in {{{field}}}")
+            parts.append((literal, field))
+        tokens.append(tuple(parts))
+    return tokens
+
 def load_config(config_path):
-    """Loads and validates configuration."""
+    """Loads and validates configuration. Returns a SimpleNamespace of parsed settings."""
     config_file = Path(config_path)
     if not config_file.is_file():
         print(f"ERROR: Configuration file not found at {config_file}", file=sys.stderr)
@@ -68,139 +129,612 @@ def load_config(config_path):
     if missing:
         sys.exit(1)
 
+    # Parse everything once into native types; the main loop only reads attributes
+    try:
+        check_interval = parser.getint('Watcher', 'checkinterval')
+        max_jobs = parser.getint('Basecaller', 'maxconcurrentjobs')
+    except ValueError as e:
+        print(f"ERROR: Invalid numeric setting: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    # Resolve the fixed paths once; they do not change for the life of the watcher
+    executable = Path(config['Basecaller']['executable']).resolve(strict=False)
+    if not executable.is_file():
+        print(f"ERROR: Basecaller executable not found: {config['Basecaller']['executable']}", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        arg_tokens = compile_arguments(config['Basecaller']['arguments'])
+    except ValueError as e:
+        print(f"ERROR: Invalid Basecaller Arguments template: {e}", file=sys.stderr)
+        sys.exit(1)
+
     # Set global marker filenames from config
     global MARKER_PROCESSING, MARKER_COMPLETED, MARKER_FAILED
     MARKER_PROCESSING = config['StateFiles']['processing']
     MARKER_COMPLETED = config['StateFiles']['completed']
     MARKER_FAILED = config['StateFiles']['failed']
 
+    # Optional persistent basecall server (e.g. guppy_basecall_server): started once so the
+    # model is loaded once, with the per-run Arguments connecting to it as clients
+    server_executable = None
+    server_arg_tokens = []
+    server_port = None
+    server_startup_timeout = 60
+    if config['Basecaller'].get('serverexecutable'):
+        server_executable = Path(config['Basecaller']['serverexecutable']).resolve(strict=False)
+        if not server_executable.is_file():
+            print(f"ERROR: Basecall server executable not found: {config['Basecaller']['serverexecutable']}", file=sys.stderr)
+            sys.exit(1)
+        try:
+            server_arg_tokens = compile_arguments(config['Basecaller'].get('serverarguments', ''), SERVER_PLACEHOLDERS)
+        except ValueError as e:
+            print(f"ERROR: Invalid Basecaller ServerArguments template: {e}", file=sys.stderr)
+            sys.exit(1)
+        try:
+            if config['Basecaller'].get('serverport'):
+                server_port = parser.getint('Basecaller', 'serverport')
+            if config['Basecaller'].get('serverstartuptimeout'):
+                server_startup_timeout = parser.getint('Basecaller', 'serverstartuptimeout')
+        except ValueError as e:
+            print(f"ERROR: Invalid numeric setting: {e}", file=sys.stderr)
+            sys.exit(1)
+
     print("Configuration loaded successfully.") # Log before logger setup
-    return config
+    return SimpleNamespace(
+        watch_dir=Path(config['Watcher']['watchdirectory']),
+        check_interval=check_interval,
+        ready_signal=config['Watcher'].get('readysignalfile') or None, # Optional
+        max_jobs=max_jobs,
+        executable=executable,
+        config_path=Path(config['Basecaller']['config']).resolve(strict=False),
+        output_base=Path(config['Basecaller']['outputbasedirectory']).resolve(strict=False),
+        arg_tokens=arg_tokens,
+        server_executable=server_executable,
+        server_arg_tokens=server_arg_tokens,
+        server_port=server_port,
+        server_startup_timeout=server_startup_timeout,
+        log_dir=config['Logging']['logdirectory'],
+        log_file=config['Logging']['logfile'],
+        log_level=config['Logging']['loglevel'],
+    )
 
 # --- State Management ---
+def list_run_entries(run_path):
+    """Returns the set of entry names in a run directory (a single getdents pass)."""
+    with os.scandir(run_path) as it:
+        return {entry.name for entry in it}
+
 def get_run_state(run_path: Path):
-    """Checks for marker files to determine the run's state."""
-    if (run_path / MARKER_PROCESSING).exists():
-        return "processing"
-    if (run_path / MARKER_COMPLETED).exists():
-        return "completed"
-    if (run_path / MARKER_FAILED).exists():
-        return "failed"
-    # Check if it's actually a directory before calling it pending
-    if run_path.is_dir():
-        return "pending"
-    return "unknown" # Not a directory or no markers
+    """Checks for marker files to determine the run's state.
+
+    Results are cached per run until the directory's mtime changes (markers
+    being created or removed) or STATE_CACHE_TTL elapses. The mtime is what keeps
+    entries correct; the TTL spans several scan periods so steady-state pending
+    runs hit the cache, and only bounds staleness on coarse-mtime filesystems.
+    """
+    run_path_str = str(run_path)
+    pending_state = MARKER_UPDATES.get(run_path_str)
+    if pending_state is not None:
+        return pending_state # Marker update queued on the pool but not yet on disk
+    try:
+        st = os.stat(run_path_str)
+    except OSError:
+        STATE_CACHE.pop(run_path_str, None)
+        return "unknown"
+    # Check if it's actually a directory before looking for markers
+    if not stat.S_ISDIR(st.st_mode):
+        return "unknown"
+
+    cached = STATE_CACHE.get(run_path_str)
+    if cached and cached[1] == st.st_mtime_ns and time.monotonic() < cached[2]:
+        return cached[0]
+
+    try:
+        names = list_run_entries(run_path_str)
+    except (NotADirectoryError, FileNotFoundError):
+        STATE_CACHE.pop(run_path_str, None)
+        return "unknown"
+    state = "pending"
+    for marker, marker_state in ((MARKER_PROCESSING, "processing"),
+                                 (MARKER_COMPLETED, "completed"),
+                                 (MARKER_FAILED, "failed")):
+        if marker in names:
+            state = marker_state
+            break
+    STATE_CACHE[run_path_str] = (state, st.st_mtime_ns, time.monotonic() + STATE_CACHE_TTL)
+    return state
+
+def clear_state_cache(run_path: Path = None):
+    """Drops the cached state for one run, or for all runs if none is given."""
+    if run_path is None:
+        STATE_CACHE.clear()
+    else:
+        STATE_CACHE.pop(str(run_path), None)
+
+def prune_state_cache(run_paths):
+    """Drops cached states for runs no longer in the watch directory."""
+    live = {str(run_path) for run_path in run_paths}
+    for run_path_str in list(STATE_CACHE): # Snapshot; the marker pool may update it concurrently
+        if run_path_str not in live:
+            STATE_CACHE.pop(run_path_str, None)
 
 def mark_run_state(run_path: Path, state_marker: str, logger: logging.Logger):
-    """Creates a marker file and removes others."""
-    markers_to_remove = [MARKER_PROCESSING, MARKER_COMPLETED, MARKER_FAILED]
+    """Creates a marker file and removes others. Returns True if the marker was set.
+
+    A transition between two states renames the existing marker, so there is a
+    single atomic step and never a moment with zero markers. Setting the processing
+    marker doubles as an exclusive claim on the run: it returns False if the run
+    already has a marker (e.g. another watcher instance claimed it first).
+    A state_marker of None removes every marker, returning the run to pending.
+    """
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    marker_paths = {marker: run_path / marker for marker in (MARKER_PROCESSING, MARKER_COMPLETED, MARKER_FAILED)}
     try:
-        # Remove the target marker from the removal list if it's being set
-        if state_marker and state_marker in markers_to_remove:
-            markers_to_remove.remove(state_marker)
-            (run_path / state_marker).touch(exist_ok=True)
-            logger.debug(f"Marked {run_path.name} with {state_marker}")
+        present = list_run_entries(run_path)
+        present_markers = [marker for marker in marker_paths if marker in present]
 
-        # Remove other markers
-        for marker in markers_to_remove:
-            marker_path = run_path / marker
-            if marker_path.exists():
+        if state_marker == MARKER_PROCESSING and present_markers:
+            return False # Already claimed or finished
+
+        if state_marker in marker_paths:
+            if not present_markers:
+                # First marker for this run. O_EXCL makes this an atomic claim, so two
+                # watchers racing on the same run cannot both launch it.
                 try:
-                    marker_path.unlink()
+                    fd = os.open(marker_paths[state_marker], os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                except FileExistsError:
+                    return False
+                os.close(fd)
+                if debug_enabled:
+                    logger.debug(f"Marked {run_path.name} with {state_marker}")
+                return True
+            if len(present_markers) == 1 and present_markers[0] != state_marker:
+                # Common case (e.g. processing -> completed): one atomic rename
+                os.rename(marker_paths[present_markers[0]], marker_paths[state_marker])
+                if debug_enabled:
+                    logger.debug(f"Marked {run_path.name} with {state_marker} (was {present_markers[0]})")
+                return True
+
+        # General case: create the target marker if needed, then remove the others
+        markers_to_remove = present_markers
+        if state_marker in marker_paths:
+            if state_marker in present_markers:
+                markers_to_remove.remove(state_marker)
+            else:
+                marker_paths[state_marker].touch(exist_ok=True)
+            if debug_enabled:
+                logger.debug(f"Marked {run_path.name} with {state_marker}")
+
+        for marker in markers_to_remove:
+            try:
+                marker_paths[marker].unlink()
+                if debug_enabled:
                     logger.debug(f"Removed marker {marker} for {run_path.name}")
-                except OSError as e:
-                    logger.warning(f"Could not remove marker {marker} for {run_path.name}: {e}")
+            except OSError as e:
+                logger.warning(f"Could not remove marker {marker} for {run_path.name}: {e}")
+        return True
 
     except OSError as e:
         logger.warning(f"Could not update state marker for {run_path.name}: {e}")
+        return False
+    finally:
+        clear_state_cache(run_path)
+
+def mark_run_state_async(run_path: Path, state_marker: str, logger: logging.Logger):
+    """Queues a completion/failure marker update on MARKER_EXECUTOR.
+
+    Keeps slow filesystems (NFS, Lustre) off the main loop. The new state is
+    recorded in MARKER_UPDATES at submit time, so get_run_state never sees a
+    stale marker in the meantime. Runs inline if no executor has been started.
+    """
+    if MARKER_EXECUTOR is None:
+        mark_run_state(run_path, state_marker, logger)
+        return
+
+    run_path_str = str(run_path)
+    MARKER_UPDATES[run_path_str] = {MARKER_PROCESSING: "processing",
+                                    MARKER_COMPLETED: "completed",
+                                    MARKER_FAILED: "failed"}[state_marker]
+
+    def _done(future):
+        MARKER_UPDATES.pop(run_path_str, None)
+        if future.exception() is not None:
+            logger.error(f"Marker update for {run_path.name} failed: {future.exception()}")
+
+    MARKER_EXECUTOR.submit(mark_run_state, run_path, state_marker, logger).add_done_callback(_done)
+
+# --- Run Detection ---
+class Inotify:
+    """One Linux inotify descriptor holding every watch, via libc (no extra dependency).
+
+    A single instance watches the watch directory for new runs and each run that is
+    still waiting for its ready signal file, so it counts once against
+    fs.inotify.max_user_instances however many runs are watched.
+    """
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, name length
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        # Close-on-exec, so basecallers can still be launched with close_fds=False
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watches = {} # Dict mapping watched Path -> watch descriptor
+        self.paths = {} # Dict mapping watch descriptor -> watched Path
+
+    def add_watch(self, path: Path, mask: int):
+        """Watches a directory for the events in mask."""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask | self.IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+        self.watches[path] = wd
+        self.paths[wd] = path
+
+    def remove_watch(self, path: Path):
+        """Stops watching a directory, if it is watched."""
+        wd = self.watches.pop(path, None)
+        if wd is not None:
+            self.paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd) # Fails harmlessly if the directory is gone
+
+    def read_events(self):
+        """Returns (watched Path, mask, name) for each queued event; the Path is None on overflow."""
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _cookie, length = self.EVENT_HEADER.unpack_from(buf, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            path = self.paths.get(wd)
+            if mask & self.IN_IGNORED and path is not None:
+                # The kernel dropped the watch (e.g. the run directory was deleted)
+                del self.paths[wd]
+                if self.watches.get(path) == wd:
+                    del self.watches[path]
+            events.append((path, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def scan_watch_directory(watch_dir: Path):
+    """Returns all non-hidden subdirectories of the watch directory."""
+    # DirEntry.is_dir() answers from the d_type returned by getdents, so only
+    # symlinked entries need an extra stat
+    with os.scandir(watch_dir) as it:
+        return [Path(entry.path) for entry in it
+                if not entry.name.startswith('.') and entry.is_dir()]
+
+def full_scan_due():
+    """True if the watch directory should be rescanned this cycle.
+
+    Without inotify every cycle scans. With it, new runs and ready signal files
+    arrive as events, and a full scan still runs once per CheckInterval to pick
+    up runs retried by removing their marker and anything missed (e.g. a watch
+    that could not be added).
+    """
+    if INOTIFY is None or LAST_FULL_SCAN is None:
+        return True
+    # One second of slack so the select() timeout wakeup always qualifies
+    return time.monotonic() - LAST_FULL_SCAN >= CONFIG.check_interval - 1
+
+def handle_inotify_events():
+    """Queues runs for new run directories and ready signal files (selector callback)."""
+    global LAST_FULL_SCAN
+    for path, mask, name in INOTIFY.read_events():
+        if mask & Inotify.IN_Q_OVERFLOW:
+            LAST_FULL_SCAN = None # Events were dropped; rescan everything on this cycle
+        elif path is None or mask & Inotify.IN_IGNORED or name.startswith('.'):
+            continue
+        elif path == CONFIG.watch_dir:
+            if mask & Inotify.IN_ISDIR:
+                PENDING_RUNS.add(path / name)
+        elif name == CONFIG.ready_signal:
+            PENDING_RUNS.add(path)
+
+def watch_run(run_path: Path, logger: logging.Logger):
+    """Watches a pending run for its ready signal file (no-op without inotify)."""
+    if INOTIFY is None or run_path in INOTIFY.watches:
+        return
+    try:
+        INOTIFY.add_watch(run_path, Inotify.IN_CREATE | Inotify.IN_MOVED_TO)
+    except OSError as e:
+        # e.g. ENOSPC at fs.inotify.max_user_watches; the periodic rescan still finds the signal
+        logger.warning(f"Could not watch {run_path.name} for its signal file: {e}")
+
+def unwatch_run(run_path: Path):
+    """Drops a run's signal file watch once it no longer needs one."""
+    if INOTIFY is not None:
+        INOTIFY.remove_watch(run_path)
+
+def start_inotify(watch_dir: Path, logger: logging.Logger):
+    """Creates the inotify instance and watches the watch directory for new runs. Returns it or None.
+
+    Runs that already exist are found by the first full scan.
+    """
+    global INOTIFY
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        INOTIFY = Inotify()
+    except (OSError, AttributeError) as e: # AttributeError: libc without inotify_init1
+        logger.warning(f"Could not initialise inotify: {e}")
+        return None
+    try:
+        INOTIFY.add_watch(watch_dir, Inotify.IN_CREATE | Inotify.IN_MOVED_TO)
+    except OSError as e:
+        logger.warning(f"Could not watch {watch_dir}: {e}")
+        INOTIFY.close()
+        INOTIFY = None
+        return None
+    logger.info("Watching for new runs and signal files with inotify.")
+    return INOTIFY
 
 # --- Basecalling Logic ---
+def build_command(executable: Path, arg_tokens, replacements):
+    """Substitutes placeholder values into compiled argument tokens."""
+    return [str(executable)] + [
+        ''.join(literal + (replacements[field] if field is not None else '') for literal, field in token)
+        for token in arg_tokens
+    ]
+
+def fail_launch(run_path: Path, message: str, logger: logging.Logger):
+    """Logs a launch error and marks the (already claimed) run as failed. Returns None."""
+    logger.error(message)
+    mark_run_state_async(run_path, MARKER_FAILED, logger)
+    return None
+
 def launch_basecaller(run_path: Path, logger: logging.Logger):
-    """Constructs and launches the basecalling command. Returns Popen object or None."""
+    """Constructs and launches the basecalling command.
+
+    Returns the Popen object, None if the launch failed, or False if the run was
+    already claimed (e.g. by another watcher instance) and was skipped.
+    """
+    # Claim the run by creating its processing marker *before* any other work
+    if not mark_run_state(run_path, MARKER_PROCESSING, logger):
+        logger.warning(f"Run {run_path.name} is already claimed or has a state marker. Skipping launch.")
+        return False
+
+    try:
+        return spawn_basecaller(run_path, logger)
+    except Exception:
+        # OSErrors are handled (and the run marked failed) in spawn_basecaller; anything
+        # else is a bug. Release the claim so the run is not left 'processing' with no
+        # process behind it, then let the error propagate.
+        mark_run_state(run_path, None, logger)
+        raise
+
+def spawn_basecaller(run_path: Path, logger: logging.Logger):
+    """Starts the basecaller for an already claimed run. Returns the Popen object, or None on failure."""
     global CONFIG, ACTIVE_PROCESSES
 
     run_name = run_path.name
-    output_base_dir = Path(CONFIG['Basecaller']['outputbasedirectory'])
-    output_run_dir = output_base_dir / run_name
-    basecaller_exe = Path(CONFIG['Basecaller']['executable'])
-    basecaller_config = Path(CONFIG['Basecaller']['config'])
-    basecaller_args_template = CONFIG['Basecaller']['arguments']
-
-    if not basecaller_exe.is_file():
-        logger.error(f"Basecaller executable not found: {basecaller_exe}")
-        mark_run_state(run_path, MARKER_FAILED, logger)
-        return None
+    output_run_dir = CONFIG.output_base / run_name
+    basecaller_exe = CONFIG.executable
 
     try:
         output_run_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f"Ensured output directory exists: {output_run_dir}")
     except OSError as e:
-        logger.error(f"Failed to create output directory {output_run_dir}: {e}")
-        mark_run_state(run_path, MARKER_FAILED, logger)
-        return None
-
-    # Format arguments using pathlib for resolved paths
-    try:
-        replacements = {
-            "input_dir": str(run_path.resolve()),
-            "output_dir": str(output_run_dir.resolve()),
-            "config_path": str(basecaller_config.resolve())
-        }
-        formatted_args = basecaller_args_template.format(**replacements)
-    except KeyError as e:
-        logger.error(f"Missing placeholder {e} in Basecaller Arguments template.")
-        mark_run_state(run_path, MARKER_FAILED, logger)
-        return None
+        return fail_launch(run_path, f"Failed to create output directory {output_run_dir}: {e}", logger)
 
-    command = [str(basecaller_exe)] + formatted_args.split()
+    # Substitute the resolved paths into the pre-split Arguments template
+    replacements = {
+        "input_dir": os.path.realpath(run_path), # Each run is launched once, so not worth caching
+        "output_dir": str(output_run_dir),
+        "config_path": str(CONFIG.config_path)
+    }
+    command = build_command(basecaller_exe, CONFIG.arg_tokens, replacements)
     logger.info(f"Attempting to launch basecalling for run: {run_name}")
     logger.info(f"Command: {' '.join(command)}")
 
-    # Mark as processing *before* launch
-    mark_run_state(run_path, MARKER_PROCESSING, logger)
-
+    # Use Popen for non-blocking execution. Redirect stdout/stderr if desired (e.g., to files)
+    # For simplicity here, let them inherit or go to PIPE if needed later.
+    # close_fds=False lets CPython launch via posix_spawn (no cwd/env/start_new_session,
+    # which disable it). It is safe because descriptors opened by Python, and the inotify
+    # descriptor (IN_CLOEXEC), are all non-inheritable.
+    # The executable is checked once in load_config; if it disappears later, execve
+    # fails and Popen raises FileNotFoundError, which is handled below.
     try:
-        # Use Popen for non-blocking execution. Redirect stdout/stderr if desired (e.g., to files)
-        # For simplicity here, let them inherit or go to PIPE if needed later.
-        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        ACTIVE_PROCESSES[str(run_path)] = process
-        logger.info(f"Successfully launched basecaller for {run_name}. PID: {process.pid}")
-        return process
-
-    except (FileNotFoundError, OSError, Exception) as e:
-        logger.error(f"Failed to launch basecaller for {run_name}: {e}")
-        mark_run_state(run_path, MARKER_FAILED, logger)
-        # Remove from active if somehow added before exception
-        ACTIVE_PROCESSES.pop(str(run_path), None)
-        return None
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                   close_fds=False)
+    except OSError as e: # ENOENT, EACCES, EMFILE, ... from spawning the executable
+        return fail_launch(run_path, f"Failed to launch basecaller for {run_name}: {e}", logger)
+
+    ACTIVE_PROCESSES[run_path] = process
+    PID_TO_RUNPATH[process.pid] = run_path
+    logger.info(f"Successfully launched basecaller for {run_name}. PID: {process.pid}")
+    return process
+
+# --- Basecall Server ---
+def start_basecall_server(logger: logging.Logger):
+    """Launches the persistent basecall server. Returns True if it is running."""
+    global BASECALL_SERVER, SERVER_STARTED_AT, SERVER_READY, SERVER_TERMINATED_AT
+    SERVER_STARTED_AT = time.monotonic()
+    SERVER_READY = False
+    SERVER_TERMINATED_AT = None
+    command = build_command(CONFIG.server_executable, CONFIG.server_arg_tokens,
+                            {"config_path": str(CONFIG.config_path)})
+    logger.info(f"Starting basecall server: {' '.join(command)}")
+    try:
+        BASECALL_SERVER = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                           close_fds=False)
+    except OSError as e:
+        logger.error(f"Failed to start basecall server: {e}")
+        return False
+    logger.info(f"Basecall server started. PID: {BASECALL_SERVER.pid}")
+    return True
+
+def basecall_server_ready(logger: logging.Logger):
+    """Returns True once the running server accepts connections on ServerPort.
+
+    Without a ServerPort the server is assumed ready ServerStartupTimeout seconds after
+    it started. With one, a server that is still not listening by then is terminated,
+    killed if it is still running SERVER_KILL_GRACE seconds later, and restarted like
+    any other server exit.
+    """
+    global SERVER_READY, SERVER_TERMINATED_AT
+    if SERVER_READY:
+        return True
+    now = time.monotonic()
+    if SERVER_TERMINATED_AT is not None:
+        if now - SERVER_TERMINATED_AT >= SERVER_KILL_GRACE:
+            logger.warning(f"Basecall server (PID: {BASECALL_SERVER.pid}) did not exit after SIGTERM; killing it.")
+            BASECALL_SERVER.kill()
+        return False
+    elapsed = now - SERVER_STARTED_AT
+    if CONFIG.server_port is None:
+        SERVER_READY = elapsed >= CONFIG.server_startup_timeout
+    else:
+        try:
+            with socket.create_connection(("127.0.0.1", CONFIG.server_port), timeout=0.5):
+                SERVER_READY = True
+        except OSError:
+            if elapsed >= CONFIG.server_startup_timeout:
+                logger.error(f"Basecall server (PID: {BASECALL_SERVER.pid}) is not listening on port "
+                             f"{CONFIG.server_port} after {CONFIG.server_startup_timeout}s; terminating it.")
+                BASECALL_SERVER.terminate() # Its exit is recorded by ensure_basecall_server
+                SERVER_TERMINATED_AT = now
+                return False
+    if SERVER_READY:
+        logger.info(f"Basecall server is ready (after {elapsed:.1f}s).")
+    return SERVER_READY
+
+def basecall_server_starting():
+    """True while a started server is not yet ready; the main loop then polls it more often."""
+    return BASECALL_SERVER is not None and not SERVER_READY
+
+def ensure_basecall_server(logger: logging.Logger):
+    """Returns True if no server is configured or it is ready, restarting it at most once per CheckInterval."""
+    if CONFIG.server_executable is None:
+        return True
+    if BASECALL_SERVER is not None:
+        # Popen.terminate() and kill() may reap an exited server themselves (CPython 3.9+),
+        # in which case waitid in reap_finished_processes never reports it
+        if BASECALL_SERVER.poll() is None:
+            return basecall_server_ready(logger)
+        record_server_exit(BASECALL_SERVER.returncode, logger)
+    if SERVER_STARTED_AT is not None and time.monotonic() - SERVER_STARTED_AT < CONFIG.check_interval:
+        return False # Restarted recently; avoid a crash loop
+    return start_basecall_server(logger) and basecall_server_ready(logger)
+
+def record_server_exit(return_code, logger: logging.Logger):
+    """Forgets an exited basecall server so it is restarted on a later cycle."""
+    global BASECALL_SERVER
+    logger.error(f"Basecall server exited (PID: {BASECALL_SERVER.pid}, Exit Code: {return_code}). "
+                 f"No new jobs will be launched until it is restarted.")
+    BASECALL_SERVER = None
+
+def stop_basecall_server(logger: logging.Logger):
+    """Terminates the basecall server on shutdown so it is never left running without a watcher.
+
+    Clients still running lose their server; their runs stay marked as processing, like
+    any job interrupted by a shutdown, and need their marker removed to be retried.
+    """
+    if BASECALL_SERVER is None:
+        return
+    if ACTIVE_PROCESSES:
+        logger.warning(f"Stopping basecall server (PID: {BASECALL_SERVER.pid}) while {len(ACTIVE_PROCESSES)} "
+                       f"job(s) are still running; they will lose their server connection.")
+    else:
+        logger.info(f"Stopping basecall server (PID: {BASECALL_SERVER.pid}).")
+    BASECALL_SERVER.terminate()
+    try:
+        BASECALL_SERVER.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        logger.warning("Basecall server did not exit after SIGTERM; killing it.")
+        BASECALL_SERVER.kill()
+        BASECALL_SERVER.wait()
+
+# --- Process Monitoring ---
+def record_process_exit(run_path: Path, process, return_code, logger: logging.Logger):
+    """Marks a run completed or failed based on its basecaller's exit code."""
+    if return_code == 0:
+        logger.info(f"Basecalling completed successfully for {run_path.name} (PID: {process.pid}).")
+        mark_run_state_async(run_path, MARKER_COMPLETED, logger)
+    else:
+        logger.error(f"Basecalling failed for {run_path.name} (PID: {process.pid}, Exit Code: {return_code}).")
+        mark_run_state_async(run_path, MARKER_FAILED, logger)
+
+def reap_finished_processes(logger: logging.Logger):
+    """Collects exited basecaller processes and updates their run markers."""
+    if not hasattr(os, "waitid"):
+        # Platforms without waitid: poll every active process. poll() does not
+        # mutate the dict, so iterate it directly and remove completions afterwards.
+        COMPLETED_BUF.clear()
+        for run_path, process in ACTIVE_PROCESSES.items():
+            return_code = process.poll() # Check if process finished
+            if return_code is not None:
+                COMPLETED_BUF.append(run_path)
+                record_process_exit(run_path, process, return_code, logger)
+
+        # Remove completed processes from active dict
+        for run_path in COMPLETED_BUF:
+            process = ACTIVE_PROCESSES.pop(run_path, None)
+            if process is not None:
+                PID_TO_RUNPATH.pop(process.pid, None)
+
+        if BASECALL_SERVER is not None and BASECALL_SERVER.poll() is not None:
+            record_server_exit(BASECALL_SERVER.returncode, logger)
+        return
+
+    # One non-blocking waitid per exited child instead of one poll() per active job.
+    # WNOWAIT leaves the child to be reaped by its Popen object so returncode is set.
+    while ACTIVE_PROCESSES or BASECALL_SERVER is not None:
+        try:
+            info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+        except ChildProcessError:
+            break # No children left
+        if info is None:
+            break # Children exist but none have exited
+
+        if BASECALL_SERVER is not None and info.si_pid == BASECALL_SERVER.pid:
+            record_server_exit(BASECALL_SERVER.wait(), logger)
+            continue
+
+        run_path = PID_TO_RUNPATH.pop(info.si_pid, None)
+        if run_path is None:
+            # Not a basecaller we launched; reap it so waitid stops reporting it
+            try:
+                os.waitpid(info.si_pid, 0)
+            except ChildProcessError:
+                pass
+            continue
+
+        process = ACTIVE_PROCESSES.pop(run_path)
+        return_code = process.wait() # Reaps the child
+        record_process_exit(run_path, process, return_code, logger)
 
 # --- Main Loop Logic ---
 def check_and_launch_jobs(logger: logging.Logger):
     """Checks active jobs, scans for pending runs, and launches new jobs."""
-    global ACTIVE_PROCESSES, CONFIG
+    global ACTIVE_PROCESSES, CONFIG, LAST_FULL_SCAN
 
-    max_jobs = int(CONFIG['Basecaller']['maxconcurrentjobs'])
-    watch_dir = Path(CONFIG['Watcher']['watchdirectory'])
-    ready_signal = CONFIG['Watcher'].get('readysignalfile') # Optional
+    max_jobs = CONFIG.max_jobs
+    watch_dir = CONFIG.watch_dir
+    ready_signal = CONFIG.ready_signal # Optional
+    debug_enabled = logger.isEnabledFor(logging.DEBUG) # Skip building debug f-strings in the scan loop
 
     # --- 1. Check Active Processes ---
-    completed_this_cycle = []
-    for run_path_str, process in list(ACTIVE_PROCESSES.items()):
-        run_path = Path(run_path_str)
-        return_code = process.poll() # Check if process finished
-
-        if return_code is not None:
-            completed_this_cycle.append(run_path_str)
-            if return_code == 0:
-                logger.info(f"Basecalling completed successfully for {run_path.name} (PID: {process.pid}).")
-                mark_run_state(run_path, MARKER_COMPLETED, logger)
-            else:
-                logger.error(f"Basecalling failed for {run_path.name} (PID: {process.pid}, Exit Code: {return_code}).")
-                mark_run_state(run_path, MARKER_FAILED, logger)
+    reap_finished_processes(logger)
 
-    # Remove completed processes from active dict
-    for run_path_str in completed_this_cycle:
-        ACTIVE_PROCESSES.pop(run_path_str, None)
+    # Clients cannot run without the basecall server (if one is configured)
+    if not ensure_basecall_server(logger):
+        return
 
     # --- 2. Scan Watch Directory for Pending Runs & Launch ---
     # Check available slots *after* polling completed jobs
@@ -211,24 +745,32 @@ def check_and_launch_jobs(logger: logging.Logger):
 
     launched_count = 0
     try:
-        # Iterate through items in watch_dir
-        for item_path in watch_dir.iterdir():
-            if available_slots <= 0: # Check again in case we filled up
+        # Runs flagged by inotify since the last cycle, plus everything on a full scan
+        candidates = set(PENDING_RUNS)
+        PENDING_RUNS.clear()
+        if full_scan_due():
+            run_paths = scan_watch_directory(watch_dir)
+            prune_state_cache(run_paths)
+            candidates.update(run_paths)
+            LAST_FULL_SCAN = time.monotonic()
+        candidates = sorted(candidates)
+
+        for index, run_path in enumerate(candidates):
+            # Check again in case we filled up or a shutdown arrived mid-scan
+            if available_slots <= 0 or SHUTDOWN_EVENT.is_set():
+                # Keep the remaining runs queued for the next cycle
+                if INOTIFY is not None:
+                    PENDING_RUNS.update(candidates[index:])
                 break
 
-            # Basic check: Is it a directory and not hidden?
-            if not item_path.is_dir() or item_path.name.startswith('.'):
-                continue
-
-            run_path = item_path
             run_name = run_path.name
-            run_path_str = str(run_path)
 
             # Is it already being processed or completed/failed?
             current_state = get_run_state(run_path)
             if current_state != "pending":
+                unwatch_run(run_path)
                 # Log if it's marked 'processing' but not in our active dict (e.g., after restart)
-                if current_state == "processing" and run_path_str not in ACTIVE_PROCESSES:
+                if current_state == "processing" and run_path not in ACTIVE_PROCESSES:
                     logger.warning(f"Run {run_name} has '{MARKER_PROCESSING}' marker but is not tracked as active. Manual check advised.")
                 continue # Skip non-pending runs
 
@@ -236,25 +778,36 @@ def check_and_launch_jobs(logger: logging.Logger):
             if ready_signal:
                 signal_file_path = run_path / ready_signal
                 if not signal_file_path.is_file():
-                    logger.debug(f"Run {run_name} is pending, waiting for signal file: {ready_signal}")
-                    continue # Not ready yet
-
-                logger.debug(f"Signal file '{ready_signal}' found for {run_name}.")
+                    # Its creation queues the run again; check once more in case it
+                    # appeared before the watch was in place
+                    watch_run(run_path, logger)
+                    if not signal_file_path.is_file():
+                        if debug_enabled:
+                            logger.debug(f"Run {run_name} is pending, waiting for signal file: {ready_signal}")
+                        continue # Not ready yet
+
+                unwatch_run(run_path)
+                if debug_enabled:
+                    logger.debug(f"Signal file '{ready_signal}' found for {run_name}.")
 
             # We have a pending, ready run, and slots MIGHT be available
             logger.info(f"Found pending and ready run: {run_name}. Checking concurrency.")
 
             if len(ACTIVE_PROCESSES) < max_jobs:
-                 if launch_basecaller(run_path, logger):
+                 process = launch_basecaller(run_path, logger)
+                 if process:
                      launched_count += 1
                      available_slots -= 1 # Decrement available slots for this cycle
-                 else:
+                 elif process is None:
                      # Launch failed, state already marked FAILED by launch_basecaller
                      logger.error(f"Failed to initiate basecalling for {run_name}. See previous errors.")
             else:
                  # This condition should technically be caught by available_slots check earlier,
                  # but good for safety.
-                 logger.debug(f"Concurrency limit reached before launching {run_name}.")
+                 if debug_enabled:
+                     logger.debug(f"Concurrency limit reached before launching {run_name}.")
+                 if INOTIFY is not None:
+                     PENDING_RUNS.update(candidates[index:])
                  break # Stop scanning if limit reached
 
         if launched_count > 0:
@@ -266,13 +819,37 @@ def check_and_launch_jobs(logger: logging.Logger):
         logger.error(f"Error scanning watch directory {watch_dir}: {e}", exc_info=True)
 
 
+# --- Main Loop Wakeups ---
+def setup_wakeup_socket():
+    """Creates the socket pair that signals write to (via set_wakeup_fd). Returns the reading end.
+
+    A socket pair rather than os.pipe(), since Windows can only select() on sockets.
+    """
+    global WAKEUP_SOCKETS
+    reader, writer = socket.socketpair()
+    reader.setblocking(False)
+    writer.setblocking(False)
+    signal.set_wakeup_fd(writer.fileno(), warn_on_full_buffer=False)
+    WAKEUP_SOCKETS = (reader, writer)
+    return reader
+
+def drain_wakeup_socket():
+    """Discards pending wakeup bytes; the caller then runs a check cycle."""
+    try:
+        while WAKEUP_SOCKETS[0].recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+
+def handle_child_signal(signum, frame):
+    """No-op: installing a handler makes SIGCHLD write to the wakeup fd."""
+
 # --- Signal Handling for Graceful Shutdown ---
 def handle_shutdown_signal(signum, frame):
-    global SHUTDOWN_REQUESTED
     logger = logging.getLogger("BasecallWatcher")
-    if not SHUTDOWN_REQUESTED:
+    if not SHUTDOWN_EVENT.is_set():
         logger.info(f"Shutdown signal ({signal.Signals(signum).name}) received. Stopping new job launches and waiting for observer...")
-        SHUTDOWN_REQUESTED = True
+        SHUTDOWN_EVENT.set()
     else:
         logger.warning("Multiple shutdown signals received. Forcing exit.")
         sys.exit(1)
@@ -285,46 +862,62 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     CONFIG = load_config(args.config)
-    logger = setup_logging(
-        CONFIG['Logging']['logdirectory'],
-        CONFIG['Logging']['logfile'],
-        CONFIG['Logging']['loglevel']
-    )
+    logger = setup_logging(CONFIG.log_dir, CONFIG.log_file, CONFIG.log_level)
 
-    watch_dir = Path(CONFIG['Watcher']['watchdirectory'])
-    check_interval = int(CONFIG['Watcher']['checkinterval'])
+    watch_dir = CONFIG.watch_dir
+    check_interval = CONFIG.check_interval
+    STATE_CACHE_TTL = STATE_CACHE_TTL_INTERVALS * check_interval
 
     if not watch_dir.is_dir():
         logger.critical(f"Watch directory does not exist or is not a directory: {watch_dir}")
         sys.exit(1)
 
-    # Setup signal handlers
+    # Setup signal handlers. Each signal also writes to the wakeup socket, so the
+    # main loop reacts immediately to shutdown requests and basecaller exits.
+    selector = selectors.DefaultSelector()
+    selector.register(setup_wakeup_socket(), selectors.EVENT_READ, drain_wakeup_socket)
     signal.signal(signal.SIGINT, handle_shutdown_signal)  # Ctrl+C
     signal.signal(signal.SIGTERM, handle_shutdown_signal) # kill command
+    if hasattr(signal, "SIGCHLD"): # Not on Windows, where exits are noticed on the timeout
+        signal.signal(signal.SIGCHLD, handle_child_signal) # Basecaller exited
 
     logger.info(f"Starting watcher on directory: {watch_dir}")
-    logger.info(f"Checking for jobs every {check_interval} seconds.")
-    if CONFIG['Watcher'].get('readysignalfile'):
-        logger.info(f"Waiting for signal file: {CONFIG['Watcher']['readysignalfile']}")
-    logger.info(f"Maximum concurrent jobs: {CONFIG['Basecaller']['maxconcurrentjobs']}")
-
-    # Note: We removed watchdog here for simplification.
-    # This means new directories are only detected during the periodic check.
-    # If near-instant detection is critical, watchdog should be added back.
-    logger.info("Running periodic checks. (Watchdog observer not used in this simplified version).")
+    logger.info(f"Checking for jobs on events, and at least every {check_interval} seconds.")
+    if CONFIG.ready_signal:
+        logger.info(f"Waiting for signal file: {CONFIG.ready_signal}")
+    logger.info(f"Maximum concurrent jobs: {CONFIG.max_jobs}")
+    if CONFIG.server_executable is not None:
+        start_basecall_server(logger)
+
+    # Completion/failure markers are written off the main loop; run claims stay synchronous
+    MARKER_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='markers')
+
+    # On Linux, new run folders and signal files are picked up from inotify events on
+    # the same selector, and the watch directory is rescanned every CheckInterval;
+    # otherwise every cycle.
+    if start_inotify(watch_dir, logger) is None:
+        logger.info("Running periodic checks. (inotify unavailable; falling back to directory scans).")
+    else:
+        selector.register(INOTIFY.fd, selectors.EVENT_READ, handle_inotify_events)
 
     try:
-        while not SHUTDOWN_REQUESTED:
+        while not SHUTDOWN_EVENT.is_set():
             check_and_launch_jobs(logger)
-            # Sleep for the interval, but break early if shutdown requested
-            for _ in range(check_interval):
-                if SHUTDOWN_REQUESTED:
-                    break
-                time.sleep(1)
+            # Block until a signal or new run event arrives; the timeout guarantees a
+            # full rescan at least every CheckInterval (see full_scan_due). A starting
+            # server is checked every second so jobs launch as soon as it is ready.
+            timeout = min(1, check_interval) if basecall_server_starting() else check_interval
+            for key, _ in selector.select(timeout=timeout):
+                key.data()
     except Exception as e:
         logger.critical(f"An unexpected error occurred in the main loop: {e}", exc_info=True)
     finally:
         logger.info("Watcher loop finished.")
+        if INOTIFY is not None:
+            INOTIFY.close()
+        stop_basecall_server(logger)
+        if MARKER_EXECUTOR is not None:
+            MARKER_EXECUTOR.shutdown(wait=True) # Make sure every marker reaches disk
         # Note: This simplified version doesn't actively manage/kill running basecaller processes on exit.
         # They will continue running unless terminated externally.
         logger.info("Existing basecaller processes will continue to run.")